@@ -7,165 +7,213 @@ a complete n-player game of Sisepai.
 """
 
 import sisepai as ssp
+from sisepai import TurnResult
 import numpy as np
+import itertools
 import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+@dataclass
+class GameState:
+    """Holds all the variables of a single game of Sisepai, so that independent
+    games can be simulated side by side (e.g. in separate processes)"""
+    deck: ssp.Deck=None
+    players: list=field(default_factory=list)
+    n_players: int=0 #fixed for the whole game, so computed once by setup_game
+    current_player: int=0
+    active_card: ssp.Card=None
+    discards: list=field(default_factory=list)
+    faceup_sets: list=field(default_factory=list)
+    turn_count: int=0
+    enable_oot: bool=True
+    verbose: bool=True
+    winner: int=-1 #index of the winning player, or -1 if nobody has won (yet)
 
 def construct_deck(nplayers):
-    """Constructs an appropriately sized deck given the number of players"""
-    global deck
+    """Constructs and returns an appropriately sized deck given the number of players"""
     if nplayers < 2:
-        deck=ssp.Deck(ndecks=1)
+        return ssp.Deck(ndecks=1)
     elif nplayers <= 4:
-        deck=ssp.Deck()
+        return ssp.Deck()
     else:
-        deck=ssp.Deck(ndecks=math.floor((nplayers+1)/2))
-
-def setup_game(agents):
-    """Populates the player array, builds the overall deck and deals cards to all players"""
-    global players; global current_player; global active_card
-    global discards; global faceup_sets; global turn_count
-
-    #Reset key variables
-    active_card=None; turn_count=0
-
-    #Initialise key arrays
-    discards=[]; faceup_sets=[]
+        return ssp.Deck(ndecks=math.floor((nplayers+1)/2))
 
+def setup_game(agents, enable_oot=True, verbose=True):
+    """Populates the player array, builds the overall deck and deals cards to all players.
+    Returns the GameState of the new game"""
     #Setup the player array with either the supplied list of agents
-    players=[a for a in agents]
+    state=GameState(players=[a for a in agents],enable_oot=enable_oot,verbose=verbose)
+    players=state.players
+    state.n_players=len(players)
 
-    construct_deck(len(players))
+    state.deck=construct_deck(state.n_players)
     #Randomly choose the player to start first
-    fp = np.random.choice(range(len(players)),1)[0]
-    current_player=fp
+    fp = int(ssp.rng.integers(state.n_players))
+    state.current_player=fp
+
+    #Every player reads the same discard pile and list of faceup sets
+    field_info=ssp.FieldInfo(state.discards,state.faceup_sets,state.deck.ndecks)
+    for p in players: p.update_field_info(field_info)
 
     #Deal cards to all players
-    for p in players: p.give_cards(deck.draw_cards(20))
+    for p in players: p.give_cards(state.deck.draw_cards(20))
     #Deal an extra card to the player to start first
-    players[fp].give_cards(deck.draw_cards(1))
+    players[fp].give_cards(state.deck.draw_cards(1))
 
     if verbose: print('Player',fp,'starts')
-
-def check_oot(drawn=False):
+    return state
+
+def oot_possible(state):
+    """Cheap test for whether check_oot could find an out-of-turn meld.  Only 3- and 4-of-a-kinds
+    can be melded out of turn, so some player must hold at least two cards identical to the
+    (non-Kuin) active card; otherwise check_oot would always return MELD"""
+    c=state.active_card
+    if c.suit == 'kuin': return False
+    for p in state.players:
+        if p.hand_counts[c.rank] > 1: return True
+    return False
+
+def check_oot(state, drawn=False):
     """Determines if any players can meld out of turn.  If so, sets the current player index to
-    the player with the highest meld priority.  Returns 'next' if a player other than the current
-    player can out-of-turn meld, or 'meld' otherwise."""
-    global players; global current_player; global active_card
-
-    cp=current_player
-    oot_sets=[]
-    for p in players: oot_sets.append(p.check_meld(active_card=active_card))
-
-    #check for 4-of-a-kind melds
-    for i in range(len(players)):
-        if oot_sets[cp] != None:
-            if ssp.is_identical_set(oot_sets[cp]) and len(oot_sets[cp].cards)==4:
-                if cp == (current_player + 1) % len(players):
-                    return 'meld' #continue as normal if the next player can meld
-                current_player=cp #shift priority to the first player found
-                return 'oot'
-        cp = (cp + 1) % len(players)
-    #4-colour beats 3-of-a-kind, but can only be melded by the current player
-    if oot_sets[cp] != None:
-        if ssp.is_four_colour_set(oot_sets[cp]): return 'meld' #no need to update current_player
-    #otherwise check for 3-of-a-kind melds
-    for i in range(len(players)):
-        if oot_sets[cp] != None:
-            if ssp.is_identical_set(oot_sets[cp]) and len(oot_sets[cp].cards)==3:
-                if cp == (current_player + 1) % len(players):
-                    return 'meld' #continue as normal if the next player can meld
-                current_player=cp #shift priority to the first player found
-                return 'oot'
-        cp = (cp + 1) % len(players)
-    return 'meld' #default
-
-
-def conduct_turn(oot_turn=False):
-    """Conducts a turn of Sisepai, updates field variables, and determines the next player to play"""
-    #Get the key gameplay variables
-    global deck; global players; global current_player
-    global faceup_sets; global discards; global active_card
-    global turn_count;
+    the player with the highest meld priority.  Returns OOT if a player other than the next
+    player can out-of-turn meld, or MELD otherwise."""
+    players=state.players; n=state.n_players
+    cp=state.current_player
+    #Classify every player's meld in a single pass, starting with the current player.
+    #Priority: 4-of-a-kind (3), then 4-colour (2, current player only), then 3-of-a-kind (1).
+    #Only a strictly higher priority replaces the best meld, so ties go to the earliest player.
+    best=0; bp=p=cp
+    for i in range(n):
+        ms=players[p].check_meld(active_card=state.active_card)
+        if ms != None:
+            if ssp.is_identical_set(ms):
+                tier=3 if len(ms.cards)==4 else 1 if len(ms.cards)==3 else 0
+            elif i == 0 and ssp.is_four_colour_set(ms): tier=2
+            else: tier=0
+            if tier > best: best=tier; bp=p
+        p = p + 1 if p + 1 < n else 0 #(cheaper than a modulo)
+    #4-colour can only be melded by the current player, so there is no need to update current_player
+    if best == 0 or best == 2: return TurnResult.MELD
+    if bp == (cp + 1 if cp + 1 < n else 0): return TurnResult.MELD #continue as normal if the next player can meld
+    state.current_player=bp #shift priority to the first player found
+    return TurnResult.OOT
+
+
+#=============================================================================#
+#STATE TRANSITIONS
+#=============================================================================#
+#These functions only update the game state; conduct_turn is responsible for
+#calling the agents and for any verbose output.
+
+def next_player(state):
+    """Passes the turn on to the next player"""
+    cp=state.current_player + 1
+    state.current_player = cp if cp < state.n_players else 0
+
+def refill_deck(state):
+    """Moves all the discards into the (empty) deck and reshuffles it.
+    Returns False if there are no discards to refill the deck with"""
+    if len(state.discards) == 0: return False
+    state.deck.add_cards(state.discards)
+    state.discards.clear() #cleared in place, as the list is shared with every player
+    return True
+
+def draw_card(state):
+    """Adds the unused active card to the discard pile and draws a new active card"""
+    state.discards.append(state.active_card)
+    state.active_card=state.deck.draw_active_card()
+
+def complete_turn(state, ms, x):
+    """Records the set melded (if any) and the card discarded by the current player"""
+    if ms != None: state.faceup_sets.append(ms)
+    state.active_card = x
+    #We only consider the turn complete once a card is discarded
+    state.turn_count += 1
+
+#=============================================================================#
+#GAME LOOP
+#=============================================================================#
+
+def conduct_turn(state, oot_turn=False):
+    """Conducts a turn of Sisepai, updates the field variables of the given game state,
+    and determines the next player to play"""
+    #Read the per-game flags once, rather than at every check below
+    players=state.players
+    verbose=state.verbose
+    allow_oot=state.enable_oot and not oot_turn #an out-of-turn meld cannot itself be interrupted
 
     if verbose: print('') #start a new line for readibility
 
-    #Give each player the updated field information
-    for p in players: p.update_field_info(discards,faceup_sets)
-
-    if len(players[current_player].collection) == 21 and active_card == None:
-        active_card=players[current_player].discard_card()
-        active_card.active=True
-        if verbose: print(players[current_player].name,'discards',active_card,'to start the game.')
-        current_player = (current_player + 1) % len(players)
-        return 'next'
+    if len(players[state.current_player].collection) == 21 and state.active_card == None:
+        state.active_card=players[state.current_player].discard_card()
+        if verbose: print(players[state.current_player].name,'discards',state.active_card,'to start the game.')
+        next_player(state)
+        return TurnResult.NEXT
     else:
         #If there are no cards left in the deck, the discarded cards form the new deck
-        if len(deck.cards) == 0:
+        if len(state.deck.cards) == 0:
             #This is near impossible in a real-life game, but is included for safety
-            if len(discards) == 0:
+            if not refill_deck(state):
                 print('Out of cards; game ends.')
-                return 'exit'
-            for c in discards: deck.cards.append(c)
-            deck.shuffle_deck()
+                return TurnResult.EXIT
             if verbose: print('Deck empty; reshuffling all discards.')
 
         #This also should not happen for there should always be an active card at the end of every turn
-        if active_card == None:
+        if state.active_card == None:
             print('An active card has gone missing; drawing another from the deck.')
-            active_card=deck.draw_active_card()
+            state.active_card=state.deck.draw_active_card()
 
         #Conduct the player's turn
-        if verbose and active_card.active==True: print('The active card is',active_card)
+        if verbose: print('The active card is',state.active_card)
 
         if oot_turn:
             #Players cannot be given the option to draw a card if they are melding out-of-turn
-            ms, x = players[current_player].play_turn(active_card=active_card,drawn=True,return_set=True)
+            ms, x = players[state.current_player].play_turn(active_card=state.active_card,drawn=True,return_set=True)
         else:
-            ms, x = players[current_player].play_turn(active_card=active_card,return_set=True)
+            ms, x = players[state.current_player].play_turn(active_card=state.active_card,return_set=True)
 
-        if x == 'draw':
-            #The ununsed active card is added to the global discard pile...
-            discards.append(active_card)
-            #...and a new card from the deck becomes the active card
-            active_card=deck.draw_active_card()
-            if verbose: print(players[current_player].name,'draws',active_card)
+        if x == TurnResult.DRAW:
+            #The ununsed active card is added to the global discard pile,
+            #and a new card from the deck becomes the active card
+            draw_card(state)
+            if verbose: print(players[state.current_player].name,'draws',state.active_card)
 
             #As a new card has been drawn, we must first check if anyone else can meld with it
-            if (not oot_turn) and enable_oot:
-                oot=check_oot(drawn=True)
-                if oot == 'oot':
-                    if verbose: print(players[current_player].name,'calls for an out-of-turn meld')
-                    return 'oot'
+            if allow_oot and oot_possible(state):
+                oot=check_oot(state,drawn=True)
+                if oot == TurnResult.OOT:
+                    if verbose: print(players[state.current_player].name,'calls for an out-of-turn meld')
+                    return TurnResult.OOT
 
             #Otherwise the current player can continue normally
-            ms, x = players[current_player].play_turn(active_card=active_card,drawn=True,return_set=True)
-            if x == 'kaeu':
-                if verbose: print(players[current_player].name,'melds',ms)
-                return 'win'
+            ms, x = players[state.current_player].play_turn(active_card=state.active_card,drawn=True,return_set=True)
+            if x == TurnResult.KAEU:
+                if verbose: print(players[state.current_player].name,'melds',ms)
+                return TurnResult.WIN
 
-        elif x == 'kaeu':
-            if verbose: print(players[current_player].name,'melds',ms)
-            return 'win'
+        elif x == TurnResult.KAEU:
+            if verbose: print(players[state.current_player].name,'melds',ms)
+            return TurnResult.WIN
 
         #If the player has melded a set, then add that set to the global list of faceup sets
-        if ms != None:
-            faceup_sets.append(ms)
-            if verbose: print(players[current_player].name,'melds',ms)
-        if verbose: print(players[current_player].name,'discards',x)
-        active_card = x
-        #We only consider the turn complete once a card is discarded
-        turn_count += 1
+        complete_turn(state,ms,x)
+        if verbose:
+            if ms != None: print(players[state.current_player].name,'melds',ms)
+            print(players[state.current_player].name,'discards',x)
 
         #Check for out-of-turn melding with this new active card
-        if (not oot_turn) and enable_oot:
-            oot=check_oot()
-            if oot == 'oot':
-                if verbose: print(players[current_player].name,'calls for an out-of-turn meld')
-                return 'oot'
+        if allow_oot and oot_possible(state):
+            oot=check_oot(state)
+            if oot == TurnResult.OOT:
+                if verbose: print(players[state.current_player].name,'calls for an out-of-turn meld')
+                return TurnResult.OOT
 
         #Otherwise pass on the turn normally
-        current_player = (current_player + 1) % len(players)
-        return 'next'
+        next_player(state)
+        return TurnResult.NEXT
 
 def play_game(nplayers=4,agents=[],nturns=0,is_verbose=True,with_oot=True):
     """Simulates a game of Sisepai.  Uses the supplied list of agents, otherwise runs
@@ -173,57 +221,79 @@ def play_game(nplayers=4,agents=[],nturns=0,is_verbose=True,with_oot=True):
     If a list of agents is supplied then this overwrites [nplayers].
     If nturns is supplied with a positive value, the game is simulated for [nturns] turns.
     Otherwise the game continues until a player wins or an exit case is reached.
-    Out-of-turn melding can be toggled; so too can verbose output."""
+    Out-of-turn melding can be toggled; so too can verbose output.
+    Returns the final GameState."""
 
-    global enable_oot
     enable_oot=with_oot if nplayers > 2 else False
-    global verbose; verbose=is_verbose
+    verbose=is_verbose
 
     #If a list of agents is provided then the game will be setup with those irrespective of whatever nplayers was set to
     if len(agents) > 0:
         if verbose: print('Setting up game with supplied list of agents')
-        setup_game(agents)
+        state=setup_game(agents,enable_oot=enable_oot,verbose=verbose)
     else:
     #Otherwise setup the game with [nplayers] default agents
         if verbose: print('Setting up game with',nplayers,'default agents')
-        setup_game([ssp.Player(name='Player '+str(i)) for i in range(nplayers)])
+        state=setup_game([ssp.Player(name='Player '+str(i)) for i in range(nplayers)],
+            enable_oot=enable_oot,verbose=verbose)
+    players=state.players
 
     oot=False
-    #Either play until someone wins...
-    if nturns < 1:
-        while True: #(MAIN GAME LOOP)
-            if oot:
-                result = conduct_turn(oot_turn=True)
-            else:
-                result = conduct_turn()
-
-            if result=='win' or result=='exit': break
-
-            if result=='oot': oot=True
-            else: oot=False
-
-        if verbose:
-            print('\nPlayer',current_player,'wins with a score of',players[current_player].total_score)
-            print('This game took',turn_count,'turns')
-
-    #...or simulate game for nturns turns
-    elif nturns > 0:
-        for i in range(nturns):
-            if oot:
-                result = conduct_turn(oot_turn=True)
-            else:
-                result = conduct_turn()
-
-            if result=='win' or result=='exit': break
-
-            if result=='oot': oot=True
-            else: oot=False
-
-        if verbose:
-            print('\nPlayer',current_player,'wins with a score of',players[current_player].total_score)
-            print('This game took',turn_count,'turns')
-
-    else: print('Invalid turn argument')
+    #Either play until someone wins, or simulate the game for nturns turns
+    turns=itertools.count() if nturns < 1 else range(nturns)
+    for i in turns: #(MAIN GAME LOOP)
+        result = conduct_turn(state,oot_turn=oot)
+        if result >= TurnResult.WIN: break
+        oot = result==TurnResult.OOT
+
+    if result==TurnResult.WIN: state.winner=state.current_player
+    if verbose:
+        print('\nPlayer',state.current_player,'wins with a score of',players[state.current_player].total_score)
+        print('This game took',state.turn_count,'turns')
+    return state
+
+def _one_game(args):
+    """Plays a single silent game in a worker process.  Returns the winner index
+    (-1 if nobody won), the number of turns and the final score of each player"""
+    seed_seq, agents_factory, nplayers, nturns, with_oot = args
+    #Every game gets its own independent random streams
+    random.seed(int(seed_seq.generate_state(1)[0]))
+    ssp.rng=np.random.default_rng(seed_seq)
+    agents=agents_factory() if agents_factory is not None else []
+    state=play_game(nplayers,agents=agents,nturns=nturns,is_verbose=False,with_oot=with_oot)
+    return state.winner, state.turn_count, [p.total_score for p in state.players]
+
+def run_n_games(n, agents_factory=None, workers=None, nplayers=4, nturns=0, with_oot=True, seed=None):
+    """Simulates [n] independent silent games in parallel over [workers] processes
+    (defaults to the number of CPUs).  [agents_factory] is called once per game to build
+    a fresh list of agents and must be picklable (i.e. a module-level function); if it is
+    not supplied then each game uses [nplayers] default agents.  Returns a list of
+    (winner, turn count, final scores) tuples, one per game."""
+    if workers is None: workers=os.cpu_count() or 1
+    seeds=np.random.SeedSequence(seed).spawn(n)
+    jobs=[(s,agents_factory,nplayers,nturns,with_oot) for s in seeds]
+    if workers < 2:
+        #_one_game reseeds the module generators, so restore the caller's afterwards
+        state, old_rng = random.getstate(), ssp.rng
+        try: return [_one_game(j) for j in jobs]
+        finally: random.setstate(state); ssp.rng=old_rng
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(_one_game,jobs,chunksize=max(1,n//workers)))
+
+def play_games_batch(n_games, nplayers=4, agents_factory=None, workers=1, nturns=0, with_oot=True, seed=None):
+    """Simulates [n_games] silent games and collects the results into arrays, returning a dict with
+    'winners' (-1 where nobody won), 'turn_counts' and 'final_scores' (one row of player scores per game).
+    The games are played in this process unless [workers] > 1, in which case they are spread
+    over a pool of processes (see run_n_games).  Every game must have the same number of players."""
+    results=run_n_games(n_games,agents_factory,workers=workers,nplayers=nplayers,
+        nturns=nturns,with_oot=with_oot,seed=seed)
+    n=len(results[0][2]) if n_games > 0 else nplayers
+    winners=np.empty(n_games,dtype=np.int32)
+    turn_counts=np.empty(n_games,dtype=np.int32)
+    final_scores=np.empty((n_games,n),dtype=np.int32)
+    for k, (w, t, sc) in enumerate(results):
+        winners[k]=w; turn_counts[k]=t; final_scores[k]=sc
+    return {'winners':winners,'turn_counts':turn_counts,'final_scores':final_scores}
 
 if __name__ == '__main__':
     play_game()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+This file contains a Monte-Carlo tree search (MCTS) agent for Sisepai.
+The search is tree-parallel: several threads descend a single shared tree,
+applying a virtual loss to the nodes they are exploring so that concurrent
+threads spread out over different moves.  Each leaf can optionally be evaluated
+by several independent playouts at once (leaf parallelisation).
+"""
+
+import sisepai as ssp
+import numpy as np
+import math
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class Node():
+    """Models a node of the search tree.  The node statistics are guarded by a lock
+    so that they can be shared between threads."""
+
+    def __init__(self, move=None, parent=None):
+        self.move=move #rank of the card discarded to reach this node
+        self.parent=parent
+        self.children=[]
+        self.visits=0
+        self.value_sum=0.0
+        self.virtual_loss=0 #number of in-flight playouts passing through this node
+        self.lock=threading.Lock()
+
+    def ucb(self, c):
+        """Upper confidence bound of the node, counting in-flight playouts as losses"""
+        n=self.visits+self.virtual_loss
+        if n == 0: return math.inf #always try unexplored moves first
+        return self.value_sum/n + c*math.sqrt(math.log(max(self.parent.visits,1))/n)
+
+    def __repr__(self):
+        return "Node %s (%d visits, %.3f mean)" % (self.move, self.visits,
+            self.value_sum/self.visits if self.visits else 0)
+
+class ThreadedMCTSDriver():
+    """Chooses a card to discard for a player by tree-parallel MCTS.
+    The root's children are the distinct cards the player may discard.  Each playout
+    deals the player random cards from those it has not yet seen and plays them out with
+    the default rules-based logic; the reward is higher the sooner the player can win.
+    Note that, as the playouts are pure Python, the threads are largely serialised by the GIL.
+    Each thread's playouts (including the simulated player's discards) draw from that thread's own
+    generator spawned from [seed], but with several threads the order in which they update the tree
+    still varies from run to run, so a seeded search is only reproducible with nthreads=1."""
+
+    def __init__(self, nplayouts=64, nthreads=4, c=math.sqrt(2), virtual_loss=1,
+        horizon=8, ndecks=None, leaf_playouts=1, seed=None):
+        self.nplayouts=nplayouts
+        self.nthreads=nthreads
+        self.leaf_playouts=leaf_playouts #number of concurrent playouts per selected leaf
+        self.c=c
+        self.virtual_loss=virtual_loss
+        self.horizon=horizon #maximum number of draws per playout
+        self.ndecks=ndecks #number of decks in play (defaults to the number recorded on the field)
+        self.seed_seq=np.random.SeedSequence(seed)
+
+    def best_move(self, player):
+        """Returns the rank of the card the player should discard, or None if there is
+        no card that can be discarded.  Blocks until all playouts have finished"""
+        moves=candidate_discards(player)
+        if len(moves) < 2: return moves[0] if moves else None
+        root=Node()
+        root.children=[Node(m,root) for m in moves]
+        pool=unseen_cards(player,self.ndecks)
+        #Split the playouts as evenly as possible between the threads
+        counts=[self.nplayouts//self.nthreads + (i < self.nplayouts%self.nthreads)
+            for i in range(self.nthreads)]
+        rngs=[np.random.default_rng(s) for s in self.seed_seq.spawn(self.nthreads)]
+        leaf_pool=ThreadPoolExecutor(max_workers=self.leaf_playouts) if self.leaf_playouts > 1 else None
+        with ThreadPoolExecutor(max_workers=self.nthreads) as ex:
+            for f in [ex.submit(self.search,root,player,pool,rng,n,leaf_pool) for rng, n in zip(rngs,counts)]:
+                f.result() #propagate any exceptions raised by the workers
+        if leaf_pool is not None: leaf_pool.shutdown()
+        return max(root.children, key=lambda x: x.visits).move
+
+    def search(self, root, player, pool, rng, nplayouts, leaf_pool=None):
+        """Runs [nplayouts] selections on the shared tree (executed by each worker thread).
+        If a leaf pool is given, each selected leaf is evaluated by [leaf_playouts]
+        independent playouts run concurrently on that pool"""
+        for i in range(nplayouts):
+            node=self.select(root)
+            if leaf_pool is None:
+                self.backpropagate(node,playout(player,node.move,pool,rng,self.horizon))
+            else:
+                rewards=leaf_pool.map(lambda r: playout(player,node.move,pool,r,self.horizon),
+                    rng.spawn(self.leaf_playouts))
+                self.backpropagate(node,sum(rewards),self.leaf_playouts)
+
+    def select(self, node):
+        """Descends the tree by UCB, applying virtual loss to every node on the way"""
+        while len(node.children) > 0:
+            with node.lock:
+                child=max(node.children, key=lambda x: x.ucb(self.c))
+                with child.lock: child.virtual_loss += self.virtual_loss
+            node=child
+        return node
+
+    def backpropagate(self, node, reward, nvisits=1):
+        """Adds the total reward of [nvisits] playouts to every node up to the root,
+        removing the virtual loss"""
+        while node is not None:
+            with node.lock:
+                node.visits += nvisits
+                node.value_sum += reward
+                if node.parent is not None: node.virtual_loss -= self.virtual_loss
+            node=node.parent
+
+class MCTSPlayer(ssp.Player):
+    """Models a player that uses MCTS to choose which card to discard.
+    Otherwise plays exactly like the default player."""
+
+    def __init__(self, name='mcts', driver=None):
+        super().__init__(name)
+        self.driver=driver if driver is not None else ThreadedMCTSDriver()
+
+    def choose_discard(self):
+        """Chooses the card to discard using the MCTS driver"""
+        if len(self.lang_pai) == 0 and self.can_win(): return None
+        move=self.driver.best_move(self)
+        if move is None: return None
+        for dc in self.hand:
+            if dc.rank == move: return dc
+
+#=============================================================================#
+#PLAYOUT FUNCTIONS
+#=============================================================================#
+
+def candidate_discards(player):
+    """Returns the distinct ranks of the cards the player may discard: the lang pai if there
+    are any, otherwise any non-Kuin card from a set that can be broken up"""
+    if len(player.lang_pai) > 0:
+        cards=player.lang_pai
+    else:
+        cards=[c for s in player.hand_sets if len(s.cards) > 1 for c in s.cards if c.suit != 'kuin']
+    return sorted(set(c.rank for c in cards))
+
+def unseen_cards(player, ndecks=None):
+    """Returns an array with the rank of every card the player has not seen,
+    given the number of decks in play (by default, the number recorded on the field)"""
+    if ndecks is None: ndecks=player.field.ndecks
+    counts=np.full(ssp.NRANKS,4*ndecks)-player.hand_counts
+    seen=[]
+    for s in player.facedown_sets: seen.extend(s.cards)
+    for s in player.field.melded_sets: seen.extend(s.cards) #includes the player's own melds
+    seen.extend(player.field.discards)
+    for c in seen: counts[c.rank] -= 1
+    assert counts.min() >= 0, "the player has seen more cards than are in %d decks" % ndecks
+    return np.repeat(np.arange(len(counts)),counts)
+
+def clone_player(player):
+    """Returns a default player with a copy of the given player's hand and sets,
+    which can be played out without affecting the original player"""
+    p=ssp.Player(name=player.name)
+    p.hand=[ssp.Card(c.colour,c.suit) for c in player.hand]
+    p.facedown_sets=player.facedown_sets.copy()
+    p.facedown_score=player.facedown_score
+    p.melded_sets=player.melded_sets.copy()
+    p.melded_score=player.melded_score
+    p.evaluate_player_hand()
+    return p
+
+def playout(player, move, pool, rng, horizon=8):
+    """Discards a card of the given rank, then deals the player up to [horizon] random cards
+    from the pool.  Returns a reward in [0,1] which is higher the sooner the player wins"""
+    sim=clone_player(player)
+    sim.random=random.Random(int(rng.integers(2**63))) #discard with the playout's generator too
+    for dc in sim.hand:
+        if dc.rank == move: break
+    sim.hand.remove(dc)
+    sim.evaluate_player_hand()
+    ndraws=min(horizon,len(pool))
+    for i, r in enumerate(rng.choice(pool,ndraws,replace=False)):
+        c=ssp.Card.from_code(int(r),active=True)
+        if sim.play_turn(active_card=c,drawn=True) == ssp.TurnResult.KAEU: return (horizon-i)/horizon
+    return 0.0
+
+if __name__ == '__main__':
+    import game
+    game.play_game(agents=[MCTSPlayer(name='MCTS')]+[ssp.Player(name='Player '+str(i)) for i in range(1,4)])
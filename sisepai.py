@@ -6,27 +6,50 @@ along with several general functions for hand evaluations, etc.
 (c) 2019 Mitchell Cavanagh
 """
 import numpy as np #required for random shuffling, etc
+import random
+import bisect
+from enum import IntEnum
+from itertools import combinations, combinations_with_replacement, product
+
+rng=np.random.default_rng() #shared generator for shuffling decks
+
+class TurnResult(IntEnum):
+    """Results passed between the players and the game loop.  WIN and EXIT are the only
+    results that end the game, so the game is over once a result is >= WIN."""
+    NEXT=0 #pass the turn on to the next player
+    MELD=1 #no out-of-turn meld; play continues as normal
+    OOT=2 #another player has called for an out-of-turn meld
+    WIN=3 #the current player has won
+    EXIT=4 #the game cannot continue
+    DRAW=5 #the player wants another card drawn from the deck
+    KAEU=6 #the customary winning call
 
 class Card():
     """Models a Sisepai Card."""
 
+    __slots__=('colour','suit','rank','active','locked','mask') #lots of cards are created per game
     validSuits=["kuin","tse","xiong","kee","mah","pau","chut"]
     validColours=["red","yellow","white","green"]
 
     def __init__(self, colour=None, suit=None, active=False):
         """Default constructor"""
         self.active=active; self.locked=False
-        if colour in self.validColours and suit in self.validSuits:
+        if colour in COLOUR_IDX and suit in SUIT_IDX:
             self.colour=colour
             self.suit=suit
             self.rank=self.calculate_rank()
         else: #Some default values for an invalid card construction
             self.colour='invalid'; self.suit='invalid'; self.rank=100
+        self.mask=1 << self.rank #bit of the card in a rank bitmask
 
     def calculate_rank(self):
         """Determine the rank of the card (from 0 to 27)"""
-        return (4*self.validSuits.index(self.suit)+4-(len(self.validColours)-
-            self.validColours.index(self.colour)))
+        return 4*SUIT_IDX[self.suit]+COLOUR_IDX[self.colour]
+
+    @classmethod
+    def from_code(cls, code, active=False):
+        """Constructs a card from its rank (as stored in the deck)"""
+        return cls(cls.validColours[code%4],cls.validSuits[code//4],active)
 
     def lock(self): self.locked=True
 
@@ -35,8 +58,15 @@ class Card():
     def __repr__(self):
         return "[%s, %s]" % (self.colour, self.suit)
 
+#Number of distinct cards (i.e. of card ranks)
+NRANKS=len(Card.validSuits)*len(Card.validColours)
+#Index of each suit and colour (a card's rank is 4*suit index + colour index)
+SUIT_IDX={s: i for i, s in enumerate(Card.validSuits)}
+COLOUR_IDX={c: i for i, c in enumerate(Card.validColours)}
+
 class Deck():
-    """Models a deck of Sisepai cards"""
+    """Models a deck of Sisepai cards.  The deck is stored as an array of card ranks;
+    Card objects are only created as the cards are drawn"""
 
     def __init__(self, ndecks=2, shuffle=True):
         self.ndecks=ndecks
@@ -44,32 +74,35 @@ class Deck():
         if shuffle: self.shuffle_deck()
 
     def populate_deck(self, ndecks=2):
-        """Creates a list of [ndeck] decks of sisepai cards"""
-        cards=[]; c=Card()
-        for i in c.validColours:
-            for j in c.validSuits:
-                for k in range(4*ndecks):
-                    cards.append(Card(i,j))
-        del c; return cards
+        """Creates an array with the ranks of [ndeck] decks of sisepai cards"""
+        ranks=4*np.arange(len(Card.validSuits))+np.arange(len(Card.validColours))[:,None]
+        return np.repeat(ranks.ravel().astype(np.int8),4*ndecks)
 
     def draw_active_card(self, shuffle=False):
         """Draws and returns a single card from the deck and makes it active"""
         if shuffle: self.shuffle_deck()
         if len(self.cards) < 1: return None
-        c=self.cards.pop()
-        c.active=True
-        return c
+        code=int(self.cards[-1])
+        self.cards=self.cards[:-1]
+        return Card.from_code(code,active=True)
 
     def draw_cards(self, ncards=1, shuffle=False):
         """Draws [ncards] from the deck.  Returns a list. Each card is inactive"""
         if shuffle: self.shuffle_deck()
         if len(self.cards)-ncards < 1: return None #POTENTIALLY CHANGE THIS CONDITION
-        dcards=[]
-        for i in range(ncards): dcards.append(self.cards.pop())
+        if ncards < 1: return []
+        #Take the cards from the top (i.e. the end) of the deck in one slice
+        dcards=[Card.from_code(code) for code in self.cards[:-ncards-1:-1].tolist()]
+        self.cards=self.cards[:-ncards]
         return dcards
 
+    def add_cards(self, cards, shuffle=True):
+        """Adds a list of cards (e.g. the discards) to the deck, then reshuffles the deck"""
+        self.cards=np.concatenate((self.cards,np.array([c.rank for c in cards],dtype=np.int8)))
+        if shuffle: self.shuffle_deck()
+
     def print_deck(self):
-        for i in self.cards: print(i)
+        for i in self.cards.tolist(): print(Card.from_code(i))
 
     def reshuffle_deck(self):
         """Reconstructs and shuffles deck according to original size"""
@@ -77,11 +110,11 @@ class Deck():
         self.shuffle_deck()
 
     def shuffle_deck(self):
-        """Shuffles the deck using np.random.shuffle"""
-        np.random.shuffle(self.cards)
+        """Shuffles the deck in place using the module's random generator"""
+        rng.shuffle(self.cards)
 
     def sort_deck(self):
-        self.cards.sort(key=lambda x: x.rank)
+        self.cards.sort()
 
     def __repr__(self):
         return "%d cards left" % len(self.cards)
@@ -93,40 +126,50 @@ class Set():
         self.cards=cards
         self.melded=contains_active_card(cards)
         self.invalid=False
-        self.same_colour=cards_same_colour(cards)
-        self.same_suit=cards_same_suit(cards)
-        self.unique_colours=cards_unique_colours(cards)
+        self.mask=cards_mask(cards)
         self.score=self.evaluate_score()
 
+    #The score only depends on the mask, so these properties are only worked out if asked for
+    @property
+    def same_colour(self): return cards_same_colour(self.cards)
+
+    @property
+    def same_suit(self): return cards_same_suit(self.cards)
+
+    @property
+    def unique_colours(self): return cards_unique_colours(self.cards)
+
     def evaluate_score(self):
-        """Determines the score of a set as per the rules of Sisepai"""
-        if self.same_suit and self.cards[0].suit != 'kuin':
-            if self.same_colour:
-                if len(self.cards) == 4: return 6 if self.melded else 8 #4-of-a-kind
-                if len(self.cards) == 3: return 1 if self.melded else 3 #3-of-a-kind
-                if len(self.cards) == 2: return 0 #pair
-            if self.unique_colours and self.cards[0].suit == 'chut':
-                if len(self.cards) == 4: return 4 #4-colour-chut
-                if len(self.cards) == 3: return 1 #3-colour chut
-        if self.same_colour:
-            suits=sorted([i.suit for i in self.cards])
-            if suits==sorted(["kuin","tse","xiong"]): return 2
-            if suits==sorted(["kee","mah","pau"]): return 1
-        if self.cards[0].suit == 'kuin' and len(self.cards) == 1: return 1
-        self.invalid=True; return -1
+        """Determines the score of a set as per the rules of Sisepai (see set_score)"""
+        score=SCORE_TABLE.get((self.mask,len(self.cards),self.melded),-1)
+        if score < 0: self.invalid=True
+        return score
 
     def __repr__(self):
         return "%s" % self.cards
 
+class FieldInfo():
+    """Models the information visible to all players on the field.  A single instance
+    is shared by every player in a game and is updated in place as the game progresses."""
+
+    def __init__(self, discards=None, melded_sets=None, ndecks=2):
+        self.discards=discards if discards is not None else [] #all discarded cards
+        self.melded_sets=melded_sets if melded_sets is not None else [] #all melded sets
+        self.ndecks=ndecks #number of decks in play
+
+    def __repr__(self):
+        return "%d discards, %d melded sets" % (len(self.discards), len(self.melded_sets))
+
 class Player():
     """Models a basic player of Sisepai."""
 
+    random=random #source of the player's random choices (e.g. set a seeded random.Random per player)
+
     def __init__(self, name='test'):
         self.name=name
-        self.field_discards=[] #store all the discarded cards visible on the field
-        self.field_melded_sets=[] #store all the melded sets visible on the field
+        self.field=FieldInfo() #the discarded cards and melded sets visible on the field
         self.total_score=0 #score of player's collection (hand, facedowns, melds)
-        self.hand=[] #all cards in current hand
+        self.hand=[] #all cards in current hand (kept sorted by rank)
         self.hand_sets=[] #sets in current hand
         self.hand_score=0 #score of all cards in the hand
         self.facedown_sets=[] #dealt sets placed face down
@@ -135,10 +178,12 @@ class Player():
         self.melded_score=0 #score of melded sets
         self.lang_pai=[] #loose cards
         self.collection=[] #list of ALL cards
+        self.meld_cache={} #check_meld results for the current hand, keyed by active card
+        self.hand_counts=[0]*NRANKS #number of cards of each rank in the hand
 
     def give_cards(self, cards):
         """Deal the player cards (essentially a second constructor)"""
-        for i in cards: self.hand.append(i)
+        self.hand.extend(cards)
         self.hand=sort_cards(self.hand)
         self.separate_facedown_sets() #remove facedown_sets
         self.evaluate_player_hand() #now evaluate the remaining hand
@@ -147,37 +192,38 @@ class Player():
         """In sisepai it is customary to place dealt sets that cannot be further
         improved (such as 4-of-a-kinds and 4-colour chut) face-down on the table.
         This function separates these ``terminal'' dealt sets from the player hand"""
-        fs, hs, lp = evaluate_hand(self.hand,return_sets=True)
+        fs, hs, lp = evaluate_hand(self.hand,return_sets=True,assume_sorted=True)
+        counts=count_ranks(self.hand) #kept up to date as sets are removed from the hand
         for s in fs:
             if len(s.cards) == 4 and cards_same_suit(s.cards):
                 #Only remove the 4-colour chut from the hand if there are
                 #no other chut in the player's hand (as is customary)
                 if cards_unique_colours(s.cards):
-                    th=[c for c in self.hand]
-                    for c in s.cards: th.remove(c)
-                    if not hand_contains_suit(th,'chut'):
+                    if sum(counts[4*CHUT:4*CHUT+4]) == 4: #i.e. only the chut in this set
                         self.facedown_sets.append(s)
-                        for c in s.cards: self.hand.remove(c)
+                        self.hand=remove_cards(self.hand,s.cards)
+                        for c in s.cards: counts[c.rank] -= 1
                         self.facedown_score += s.score
                 #Otherwise 4-of-a-kinds can be removed immediately
                 elif cards_same_colour(s.cards):
                     self.facedown_sets.append(s)
-                    for c in s.cards: self.hand.remove(c)
+                    self.hand=remove_cards(self.hand,s.cards)
+                    for c in s.cards: counts[c.rank] -= 1
                     self.facedown_score += s.score
 
     def play_turn(self, active_card=None, drawn=False, return_set=False):
-        """Models the player turn, returns a card to discard.  Returns draw if
+        """Models the player turn, returns a card to discard.  Returns DRAW if
         no sets can be melded - this is so that game.py knows to deal another card.
-        Returns kaeu (the customary winning call) if, after a meld, the player can win.
+        Returns KAEU (the customary winning call) if, after a meld, the player can win.
         Here the player only melds if doing so results in a higher score.
         Returns the melded set if the return_set flag is set to true.
         The player can now Tok given that they have at least one lang pai to discard.
         This implementation is a simple rules-based AI based on observations of typical gameplay"""
         #Evaluate the hand combined with the active card
-        old_hand=[c for c in self.hand]
-        h=[c for c in self.hand]
-        h.append(active_card)
-        fs, hs, lp = evaluate_hand(h,return_sets=True)
+        old_hand=self.hand.copy()
+        h=self.hand.copy()
+        bisect.insort(h,active_card,key=card_rank) #keep the hand sorted
+        fs, hs, lp = evaluate_hand(h,return_sets=True,assume_sorted=True)
         ms = None
         #MELD CRITERIA
         if hs > self.hand_score or self.can_tok(hs,lp):
@@ -186,15 +232,15 @@ class Player():
                 if s.melded:
                     self.melded_sets.append(s)
                     self.melded_score += s.score
-                    for c in s.cards: h.remove(c)
+                    h=remove_cards(h,s.cards)
                     ms = s
             #Update the player's hand
             self.hand = h
             self.evaluate_player_hand()
             #Assess winning condition
             if self.can_win():
-                if return_set: return ms, 'kaeu'
-                return 'kaeu'
+                if return_set: return ms, TurnResult.KAEU
+                return TurnResult.KAEU
             #Choose a card to discard
             else:
                 dc = self.discard_card()
@@ -209,9 +255,8 @@ class Player():
                         if return_set: return None, active_card
                         return active_card
                     else:
-                        if return_set: return None, 'draw'
-                        return 'draw'
-                dc.active=True #activate the discarded card
+                        if return_set: return None, TurnResult.DRAW
+                        return TurnResult.DRAW
                 if return_set: return ms, dc
                 return dc
         elif drawn:
@@ -219,32 +264,42 @@ class Player():
             if return_set: return ms, active_card
             return active_card
         else:
-            #Return draw so game.py knows to provide another card
-            if return_set: return None, 'draw'
-            return 'draw'
+            #Return DRAW so game.py knows to provide another card
+            if return_set: return None, TurnResult.DRAW
+            return TurnResult.DRAW
 
     def check_meld(self, active_card):
         """Returns the set that the player can meld with the given active card,
         or none if no such set exists.  Note this does NOT make any changes to
-        the player hand and/or score."""
-        h=[c for c in self.hand]
-        h.append(active_card)
-        fs, hs, lp = evaluate_hand(h,return_sets=True)
+        the player hand and/or score.  Results are cached until the hand changes."""
+        key=(active_card.rank,active_card.active)
+        if key in self.meld_cache:
+            c, ms = self.meld_cache[key]
+            if ms==None or c is active_card: return ms
+            #Rebuild the cached set with the given copy of the active card
+            return Set([active_card if i is c else i for i in ms.cards])
+        #Skip the full hand evaluation if the hand cannot form any set with the active card
+        if not can_form_set(self.hand_counts,active_card.rank):
+            self.meld_cache[key]=(active_card,None)
+            return None
+        h=self.hand.copy()
+        bisect.insort(h,active_card,key=card_rank) #keep the hand sorted
+        fs, hs, lp = evaluate_hand(h,return_sets=True,assume_sorted=True)
         ms = None
         for s in fs:
             if s.melded: ms=s; break
-        #If there is no such melded set then return None right away
-        if ms==None: return None
         #Otherwise we need to ensure that the player can discard
         #and that the meld actually increases the player's hand score
-        fs.remove(ms)
-        if (len(lp) > 0 or exists_nks(fs)) and hs > self.hand_score: return ms
-        return None
+        if ms!=None:
+            fs.remove(ms)
+            if not ((len(lp) > 0 or exists_nks(fs)) and hs > self.hand_score): ms = None
+        self.meld_cache[key]=(active_card,ms)
+        return ms
 
     def update_scores(self):
         """Test function - Refreshes all score variables"""
         self.hand_score = self.melded_score = self.facedown_score = self.total_score = 0
-        hs, lp = evaluate_hand(self.hand)
+        hs, lp = evaluate_hand(self.hand,assume_sorted=True)
         self.hand_score = hs
         for s in self.facedown_sets: self.facedown_score += s.score
         for s in self.melded_sets: self.melded_score += s.score
@@ -252,22 +307,22 @@ class Player():
 
     def update_collection(self):
         """Test function - Rebuilds and re-sorts the list of all player cards"""
-        self.collection=[]
-        for c in self.hand: c.locked=False; self.collection.append(c)
-        for s in self.facedown_sets:
-            for c in s.cards: self.collection.append(c)
-        for s in self.melded_sets:
-            for c in s.cards: self.collection.append(c)
+        for c in self.hand: c.locked=False
+        self.collection=self.hand.copy()
+        for s in self.facedown_sets: self.collection.extend(s.cards)
+        for s in self.melded_sets: self.collection.extend(s.cards)
         self.collection=sort_cards(self.collection)
 
     def evaluate_player_hand(self):
         """Evaluates the sets in the player's hand.  This should be called after
         removing any facedown and melded sets.  Also calls update_collection()"""
-        fs, hs, lp = evaluate_hand(self.hand,return_sets=True)
+        fs, hs, lp = evaluate_hand(self.hand,return_sets=True,assume_sorted=True)
         self.hand_sets = fs
         self.hand_score = hs
         self.lang_pai = lp
         self.total_score = self.hand_score + self.facedown_score + self.melded_score
+        self.meld_cache={} #the hand has changed, so previous check_meld results are stale
+        self.hand_counts=count_ranks(self.hand)
         self.update_collection()
 
     def can_win(self):
@@ -280,14 +335,20 @@ class Player():
         and len(self.lang_pai) > 0 and self.total_score >= 9)
 
     def discard_card(self):
-        """Discards a random lang pai, or breaks up a pair/chut if there are
-        no lang pai"""
+        """Removes the card chosen by choose_discard() from the hand and returns it.
+        The discarded card becomes the active card.  Returns None if nothing can be discarded"""
+        dc = self.choose_discard()
+        if dc==None: return None
+        self.hand.remove(dc)
+        self.evaluate_player_hand() #update player hand
+        dc.active=True #activate the discarded card
+        return dc
+
+    def choose_discard(self):
+        """Chooses a random lang pai to discard, or breaks up a pair/chut if there are
+        no lang pai.  Note this does NOT make any changes to the player hand"""
         if len(self.lang_pai) > 0:
-            #use [0] to extract the object rather than the numpy array
-            dc = np.random.choice(self.lang_pai,1)[0]
-            self.hand.remove(dc)
-            self.evaluate_player_hand() #update player hand
-            return dc
+            return self.random.choice(self.lang_pai)
         elif not self.can_win():
             #We need to first determine if there are any non-Kuin sets to break up
             #If not, then we cannot discard anything (Kuin cannot be discarded)
@@ -296,37 +357,25 @@ class Player():
             #Attempt to break a pair
             for s in self.hand_sets:
                 if len(s.cards) == 2:
-                    dc = np.random.choice(s.cards,1)[0]
-                    self.hand.remove(dc)
-                    self.evaluate_player_hand() #update player hand
-                    return dc
+                    return self.random.choice(s.cards)
             #Otherwise break a 3-colour chut (as this set has the highest probability
             #of being able to be melded again later)
             for s in self.hand_sets:
                 if len(s.cards) == 3 and cards_all_suit(s.cards,suit='chut'):
-                    dc = np.random.choice(s.cards,1)[0]
-                    self.hand.remove(dc)
-                    self.evaluate_player_hand() #update player hand
-                    return dc
+                    return self.random.choice(s.cards)
             #Otherwise break a random non-Kuin set with the lowest score
             ms = 10 #some impossibly high number
             for s in self.hand_sets:
                 if len(s.cards) > 1 and s.score < ms: ms = s.score
-            rs = np.random.choice(self.hand_sets,1)[0]
             #Now choose a random non-Kuin set with this minimum score
-            while len(rs.cards) == 1 or rs.score != ms:
-                rs = np.random.choice(self.hand_sets,1)[0]
-            dc = np.random.choice(rs.cards,1)[0]
-            self.hand.remove(dc)
-            self.evaluate_player_hand()
-            return dc
+            rs = self.random.choice([s for s in self.hand_sets if len(s.cards) > 1 and s.score == ms])
+            return self.random.choice(rs.cards)
         else:
             return None
 
-    def update_field_info(self,dcards,msets):
-        """Update information about the field of player"""
-        self.field_discards=[dc for dc in dcards]
-        self.field_melded_sets=[ms for ms in msets]
+    def update_field_info(self,field):
+        """Give the player the (shared) information about the field"""
+        self.field=field
 
     def print_hand(self): print(self.hand)
 
@@ -356,11 +405,11 @@ def cards_same_suit(cards):
 
 def cards_unique_colours(cards):
     """Determines if each card is of a unique colour"""
+    seen=0 #bitmask of the colours seen so far (the colour index is the low 2 bits of the rank)
     for i in cards:
-        test_colour=i.colour
-        for j in cards:
-            if i == j: continue
-            if j.colour == test_colour: return False
+        bit=1 << (i.rank & 3)
+        if seen & bit: return False
+        seen |= bit
     return True
 
 def cards_all_suit(cards, suit):
@@ -371,8 +420,9 @@ def cards_all_suit(cards, suit):
 
 def cards_not_in(cards, card_list):
     """Determines if each card in a list of cards does not appear in another list"""
+    ids={id(c) for c in card_list} #cards are compared by identity
     for i in cards:
-        if i in card_list: return False
+        if id(i) in ids: return False
     return True
 
 def cards_not_locked(cards):
@@ -387,21 +437,76 @@ def contains_active_card(cards):
         if i.active: return True
     return False
 
+def remove_cards(cards, removed):
+    """Returns a copy of a list of cards without the given cards.  Cards are matched
+    by identity, so this takes a single pass however many cards are removed"""
+    ids={id(c) for c in removed}
+    return [c for c in cards if id(c) not in ids]
+
+def cards_mask(cards):
+    """Returns the rank bitmask of a list of cards, i.e. the bitwise OR of each card's mask.
+    Identical cards share the same bit."""
+    mask=0
+    for i in cards: mask |= i.mask
+    return mask
+
+#Rank bitmask of the four chut, one of each colour
+FOUR_CHUT_MASK=cards_mask([Card(i,'chut') for i in Card.validColours])
+
 def is_identical_set(set):
-    """Determines if the given set is an identical set"""
-    return cards_same_suit(set.cards) and cards_same_colour(set.cards)
+    """Determines if the given set is an identical set (i.e. only one bit of its mask is set)"""
+    return set.mask & (set.mask-1) == 0
 
 def is_four_colour_set(set):
     """Determines if the given set is a 4-colour set"""
-    return (cards_same_suit(set.cards) and cards_unique_colours(set.cards)
-    and len(set.cards)==4 and set.cards[0].suit=='chut')
+    return set.mask == FOUR_CHUT_MASK and len(set.cards)==4
+
+def count_ranks(cards):
+    """Returns the number of cards of each rank in a list of cards"""
+    counts=[0]*NRANKS
+    for i in cards: counts[i.rank] += 1
+    return counts
+
+def build_meld_table():
+    """For each card rank, lists every combination of other cards (as tuples of
+    (rank, count) pairs) that a hand needs in order to form a scoring set with that card"""
+    table=[]
+    for suit in Card.validSuits:
+        for colour in Card.validColours:
+            rank=4*SUIT_IDX[suit]+COLOUR_IDX[colour]
+            needs=[]
+            if suit == 'kuin': needs.append(()) #kuin score on their own
+            else: needs.append(((rank,2),)) #3-of-a-kind (which a 4-of-a-kind also needs)
+            for group in (["kuin","tse","xiong"],["kee","mah","pau"]):
+                if suit in group: needs.append(tuple((4*SUIT_IDX[i]+COLOUR_IDX[colour],1) for i in group if i != suit))
+            if suit == 'chut': #3-colour chut (which a 4-colour chut also needs)
+                others=[4*SUIT_IDX['chut']+COLOUR_IDX[i] for i in Card.validColours if i != colour]
+                needs.extend(((a,1),(b,1)) for a, b in combinations(others,2))
+            table.append(needs)
+    return table
+
+#MELD_TABLE[rank] lists what a hand needs to form a set with a card of that rank
+MELD_TABLE=build_meld_table()
+
+def can_form_set(counts, rank):
+    """Determines if a hand (given by its rank counts) can form a scoring set with a card of the
+    given rank.  If not, adding the card leaves the hand score unchanged (at most forming a pair)"""
+    for needs in MELD_TABLE[rank]:
+        for r, n in needs:
+            if counts[r] < n: break
+        else: return True
+    return False
+
+def card_rank(card):
+    """Sort key for cards (sorting by rank also sorts by suit)"""
+    return card.rank
 
 def sort_cards(cards, by='suit'):
     """Sorts cards either by suit or by colour"""
-    cards.sort(key=lambda x: x.rank)
+    cards.sort(key=card_rank)
     if by=='colour':
         sorted_cards=[]
-        for i in cards[0].validColours:
+        for i in Card.validColours:
             for j in cards:
                 if j.colour == i: sorted_cards.append(j)
     else: sorted_cards=cards
@@ -435,107 +540,167 @@ def exists_nks(hand_sets):
 
 def get_sisepai_cards(activate=False):
     """Returns a list of all 28 unique Sisepai cards (active cards optional)"""
-    cards=[]; c = Card()
-    for i in c.validColours:
-        for j in c.validSuits:
-            cards.append(Card(i,j,active=activate))
-    return cards
-
-def evaluate_hand(hand_cards, return_sets=False):
+    return [Card(i,j,active=activate) for i in Card.validColours for j in Card.validSuits]
+
+#Suit indices used by evaluate_hand, which works on integer ranks (suit = rank>>2, colour = rank&3)
+KUIN=SUIT_IDX['kuin']
+CHUT=SUIT_IDX['chut']
+#Suit bitmasks (with bit i set for suit i) of the two consecutive sets
+KUIN_TSE_XIONG_MASK=(1 << KUIN) | (1 << SUIT_IDX['tse']) | (1 << SUIT_IDX['xiong'])
+KEE_MAH_PAU_MASK=(1 << SUIT_IDX['kee']) | (1 << SUIT_IDX['mah']) | (1 << SUIT_IDX['pau'])
+
+def set_score(same_suit, same_colour, unique_colours, melded, n, suits):
+    """Determines the score of a set of [n] cards from its properties as per the rules of Sisepai,
+    where suits is the suit bitmask of the cards.  Returns -1 if the cards do not form a set"""
+    suit=suits.bit_length()-1 #the suit of the cards if they are all the same suit
+    if same_suit and suit != KUIN:
+        if same_colour:
+            if n == 4: return 6 if melded else 8 #4-of-a-kind
+            if n == 3: return 1 if melded else 3 #3-of-a-kind
+            if n == 2: return 0 #pair
+        if unique_colours and suit == CHUT:
+            if n == 4: return 4 #4-colour-chut
+            if n == 3: return 1 #3-colour chut
+    if same_colour and n == 3:
+        if suits == KUIN_TSE_XIONG_MASK: return 2
+        if suits == KEE_MAH_PAU_MASK: return 1
+    if suit == KUIN and n == 1: return 1
+    return -1
+
+def build_score_table():
+    """Tabulates set_score for every combination of up to 4 cards that forms a valid set"""
+    table={}
+    for n in range(1,5):
+        for ranks in combinations_with_replacement(range(NRANKS),n):
+            colours=set(r & 3 for r in ranks)
+            suits=0
+            for r in ranks: suits |= 1 << (r >> 2)
+            mask=0
+            for r in ranks: mask |= 1 << r
+            for melded in (False,True):
+                score=set_score(suits & (suits-1) == 0,len(colours) == 1,len(colours) == n,melded,n,suits)
+                if score >= 0: table[(mask,n,melded)]=score
+    return table
+
+#SCORE_TABLE[(rank bitmask, ncards, melded)] is the score of a set of cards with those properties
+#(which determine the set up to the order of its cards).  Anything not in the table is not a valid set.
+SCORE_TABLE=build_score_table()
+
+#Cache of evaluate_hand results, keyed by the rank and active flag of each card in the sorted hand.
+#The sets and lang pai are stored as card indices so that they apply to any hand with the same key
+EVAL_CACHE={}
+EVAL_CACHE_SIZE=65536 #the cache is emptied once it reaches this many hands
+
+def evaluate_hand(hand_cards, return_sets=False, assume_sorted=False):
     """Determines the combined score of all sets from the given list of cards.
-    Returns a list of found sets (optional), the hand score and a list of lang pai"""
+    Returns a list of found sets (optional), the hand score and a list of lang pai.
+    Set assume_sorted if the cards are already sorted by rank, to skip sorting them.
+    Results are cached, as near-identical hands are evaluated over and over during a game"""
+
+    cards=hand_cards if assume_sorted else sort_cards(hand_cards)
+    key=tuple([c.rank << 1 | c.active for c in cards])
+    hit=EVAL_CACHE.get(key) #a single lookup, as another thread may clear the cache at any time
+    if hit is not None:
+        set_idx, hand_score, lp_idx = hit
+        lang_pai=[cards[i] for i in lp_idx]
+        if return_sets: return [Set([cards[i] for i in t]) for t in set_idx], hand_score, lang_pai
+        return hand_score, lang_pai
+
+    found_sets, hand_score, lang_pai = search_hand(cards)
+    pos={id(c): i for i, c in enumerate(cards)}
+    if len(EVAL_CACHE) >= EVAL_CACHE_SIZE: EVAL_CACHE.clear()
+    EVAL_CACHE[key]=(tuple(tuple(pos[id(c)] for c in s.cards) for s in found_sets),
+        hand_score, tuple(pos[id(c)] for c in lang_pai))
+
+    if return_sets: return found_sets, hand_score, lang_pai
+    return hand_score, lang_pai
 
-    cards=sort_cards(hand_cards) #Just in case the given cards are not yet sorted
+def search_hand(cards):
+    """Searches a sorted list of cards for sets (this does the work for evaluate_hand).
+    Returns the list of found sets, the hand score and a list of lang pai"""
     hand_score=0
     found_sets=[]
     lang_pai=[] #Loose cards that do not form sets
-    valid_multicolour_suits=['chut']
-
-    i=0
-    #First we look for 4-card identical sets, performing a simple linear search
-    while i <= len(cards)-4:
-        #Note that we can simply use valid_scores as a way to check if the sets
-        #correspond to identical cards as ONLY 4-of-a-kind sets can have these values.
-        valid_scores=[8,6]
-        test_cards=cards[i:i+4]
-        test_set=Set(test_cards)
-        if test_set.score in valid_scores and cards_not_locked(test_cards):
-            found_sets.append(test_set)
-            for c in test_cards: c.lock()
-            i += 3
-        i += 1
-
-    #Now we look for 4-card multicolour sets.  This requires a quadruple loop
+    #The search works on the integer ranks of the cards.  Set objects are only built for
+    #the sets that are found, and locking is tracked locally.
+    n=len(cards)
+    ranks=[c.rank for c in cards]
+    #As the cards are sorted, the cards of each rank form a block starting at start[rank].
+    #Each stage locks the cards of a rank from the front of its block, so the locked cards
+    #of a rank are always the first taken[rank] cards of the block.
+    counts=[0]*NRANKS
+    start=[0]*NRANKS
+    for i in range(n-1,-1,-1): counts[ranks[i]] += 1; start[ranks[i]]=i
+    taken=[0]*NRANKS
+    locked=[False]*n
+    #Only these ranks can form identical sets (Kuin cannot form identical sets)
+    multiples=[r for r in range(NRANKS) if counts[r] > 1 and r>>2 != KUIN]
+
+    #First we look for 4-card identical sets
+    for r in multiples:
+        for i in range(start[r],start[r]+counts[r]-3,4):
+            found_sets.append(Set(cards[i:i+4]))
+            locked[i]=locked[i+1]=locked[i+2]=locked[i+3]=True
+        taken[r]=counts[r]-counts[r]%4
+
+    #Now we look for 4-card multicolour sets, i.e. one unlocked chut of each colour
     #This also solves the Green Chut cases of the form
     #[red chut, yellow chut, white chut, green chut, green chut, green chut, green chut]
     #since 4-of-a-kinds are now checked first, THEN followed by 4-colour chut.
-    for i in range(len(cards)):
-        if cards[i].suit not in valid_multicolour_suits: continue
-        #It is assumed that, if i is chut, then j,k,l will also all be chut
-        for j in range(i+1,len(cards)):
-            for k in range(j+1,len(cards)):
-                for l in range(k+1,len(cards)):
-                    test_cards=[cards[i],cards[j],cards[k],cards[l]]
-                    test_set=Set(test_cards)
-                    if test_set.score == 4 and cards_not_locked(test_cards):
-                        found_sets.append(test_set)
-                        for c in test_cards: c.lock()
-
-    i=0
+    chut_by_colour=[range(start[r]+taken[r],start[r]+counts[r]) for r in range(4*CHUT,4*CHUT+4)]
+    for i, j, k, l in product(*chut_by_colour):
+        if not (locked[i] or locked[j] or locked[k] or locked[l]):
+            found_sets.append(Set([cards[i],cards[j],cards[k],cards[l]]))
+            for x in (i,j,k,l): locked[x]=True; taken[ranks[x]] += 1
+
     #Now we look for 3-card identical sets (specifically exclude consecutive + multicolour sets)
-    while i <= len(cards)-3:
-        valid_scores=[3,1] #valid scores for 3-card identical sets
-        test_cards=cards[i:i+3]
-        #Need to ensure that the cards are actually identical
-        #This fixes cases like [kee mah pao pao pao] where the kee mah pao incorrectly takes precedence
-        if cards_same_suit(test_cards) and cards_same_colour(test_cards):
-            test_set=Set(test_cards)
-            if test_set.score in valid_scores and cards_not_locked(test_cards):
-                found_sets.append(test_set)
-                for c in test_cards: c.lock()
-                i += 2
-        i += 1
-
-    #Now we look for 3-card consecutive and other multicolour sets
-    for i in range(len(cards)):
-        for j in range(i+1,len(cards)):
-            for k in range(j+1,len(cards)):
-                #Look for both kuin-tse-xiong, kee-mah-pau and 3-colour-chut
-                valid_scores=[2,1]
-                test_cards=[cards[i],cards[j],cards[k]]
-                test_set=Set(test_cards)
-                if test_set.score in valid_scores and cards_not_locked(test_cards):
-                    found_sets.append(test_set)
-                    for c in test_cards: c.lock()
+    #This fixes cases like [kee mah pao pao pao] where the kee mah pao incorrectly takes precedence
+    for r in multiples:
+        for i in range(start[r]+taken[r],start[r]+counts[r]-2,3):
+            found_sets.append(Set(cards[i:i+3]))
+            locked[i]=locked[i+1]=locked[i+2]=True
+        taken[r]=counts[r]-(counts[r]-taken[r])%3
+
+    #Now we look for 3-card consecutive and other multicolour sets.  These can only be formed
+    #within a colour (kuin-tse-xiong, kee-mah-pau) or within the chut (3-colour chut), so the
+    #candidate combinations are only enumerated within those groups of unlocked cards.
+    #(Identical sets need not be considered: at most 2 cards of each rank are left unlocked)
+    by_rank=[[] for r in range(NRANKS)] #indices of the unlocked cards of each rank
+    for i in range(n):
+        if not locked[i]: by_rank[ranks[i]].append(i)
+    candidates=[]
+    #(As the cards are sorted, taking one card of each rank in rank order keeps the indices sorted)
+    for c in range(len(Card.validColours)):
+        for group in ((0,1,2),(3,4,5)): #kuin-tse-xiong and kee-mah-pau suits
+            candidates.extend(product(*[by_rank[4*i+c] for i in group]))
+    for colours in combinations(range(4*CHUT,4*CHUT+4),3): #3-colour chut
+        candidates.extend(product(*[by_rank[r] for r in colours]))
+    #Check the candidates in the same order as a full search over all combinations.
+    #Every candidate is a valid set worth 2 (kuin-tse-xiong) or 1
+    for i, j, k in sorted(candidates):
+        if locked[i] or locked[j] or locked[k]: continue
+        found_sets.append(Set([cards[i],cards[j],cards[k]]))
+        for x in (i,j,k): locked[x]=True; taken[ranks[x]] += 1
 
     #Now we check for standalone Kuin
-    for i in cards:
-        if i.suit=='kuin' and not i.locked:
-            found_sets.append(Set([i])) #Set takes a list of cards!
-            i.lock()
+    for r in range(4*KUIN,4*KUIN+4):
+        for i in range(start[r]+taken[r],start[r]+counts[r]):
+            found_sets.append(Set([cards[i]])) #Set takes a list of cards!
+        taken[r]=counts[r]
 
-    i=0
     #Finally, check for pairs
-    while i <= len(cards)-2:
-        test_cards=cards[i:i+2]
-        test_set=Set(test_cards)
-        if test_set.score == 0 and cards_not_locked(test_cards):
-            found_sets.append(test_set)
-            for c in test_cards: c.lock()
-        i += 1
+    for r in multiples:
+        for i in range(start[r]+taken[r],start[r]+counts[r]-1,2): found_sets.append(Set(cards[i:i+2]))
+        taken[r]=counts[r]-(counts[r]-taken[r])%2
 
     #Now determine the hand score
     for s in found_sets: hand_score += s.score
 
     #And finally determine the lang pai (note pairs are not lang pai)
-    for c in cards:
-        if not c.locked: lang_pai.append(c)
+    for i in range(n):
+        if i-start[ranks[i]] >= taken[ranks[i]]: lang_pai.append(cards[i])
 
-    #Unlock the cards so that they can be checked again
-    for c in cards: c.locked=False
-
-    if return_sets: return found_sets, hand_score, lang_pai
-    return hand_score, lang_pai
+    return found_sets, hand_score, lang_pai
 
 if __name__ == '__main__':
     d=Deck()